@@ -1,6 +1,8 @@
 
 import pytest
 
+pytest_plugins = ['pytest_latency', 'pytester']
+
 
 @pytest.fixture
 def accounting_url(request):
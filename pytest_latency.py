@@ -0,0 +1,243 @@
+
+"""
+pytest plugin recording the client-side latency of every HTTP request made with requests.
+
+Every request is broken down into DNS lookup, connect, time to first byte (TTFB) and transfer; timing headers
+reported by the server (Server-Timing, X-Response-Time, X-Runtime) are recorded as well. A request exceeding the
+latency budget of its endpoint (--latency-budget options, or else the ini option latency_budgets) fails its test,
+and the slowest requests are reported at the end of the session.
+"""
+
+import fnmatch
+import json
+import re
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+import urllib3.util.connection
+
+# DNS and connect times of the request currently sent by a thread
+connection_times = threading.local()
+
+
+class Call:
+    """Timings of one HTTP request, in seconds."""
+
+    def __init__(self, nodeid, method, url, status, dns, connect, ttfb, transfer, server):
+        self.nodeid = nodeid
+        self.method = method
+        self.url = url
+        self.status = status
+        self.dns = dns
+        self.connect = connect
+        self.ttfb = ttfb
+        self.transfer = transfer
+        self.server = server
+        self.budget = None
+
+    @property
+    def total(self):
+        return self.dns + self.connect + self.ttfb + self.transfer
+
+    @property
+    def path(self):
+        return urlsplit(self.url).path
+
+    @property
+    def endpoint(self):
+        """Method and path, with ids (prefixes, drop ids, file names, ...) replaced by '*'."""
+        segments = ['*' if re.search(r'\d', segment) and len(segment) >= 4 or len(segment) >= 20 else segment
+                    for segment in self.path.split('/')]
+        return self.method + ' ' + '/'.join(segments)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.total > self.budget
+
+    def as_dict(self):
+        return {
+            'nodeid': self.nodeid,
+            'method': self.method,
+            'url': self.url,
+            'endpoint': self.endpoint,
+            'status': self.status,
+            'dns': self.dns,
+            'connect': self.connect,
+            'ttfb': self.ttfb,
+            'transfer': self.transfer,
+            'total': self.total,
+            'server': self.server,
+            'budget': self.budget,
+        }
+
+    def __str__(self):
+        timings = 'dns {:.1f} connect {:.1f} ttfb {:.1f} transfer {:.1f}'.format(
+            self.dns * 1000, self.connect * 1000, self.ttfb * 1000, self.transfer * 1000)
+        line = '{:8.1f} ms ({}) {} {} -> {}'.format(self.total * 1000, timings, self.method, self.url, self.status)
+        if self.server:
+            line += ' [server: {}]'.format(', '.join('{} {:.1f} ms'.format(*item) for item in self.server.items()))
+        if self.budget is not None:
+            line += ' [budget: {:.1f} ms]'.format(self.budget * 1000)
+        return line
+
+
+# Factors to milliseconds of the units allowed in timing headers
+UNITS = {'': 1, 'ms': 1, 's': 1000, 'us': 0.001}
+
+
+def milliseconds(value, default_unit):
+    """Parse a duration like "12.5", "12.5ms" or "0.5s" (*default_unit* if none is given) into milliseconds."""
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)\s*([a-z]*)\s*', value)
+    if not match or match.group(2) not in UNITS:
+        return None
+    return float(match.group(1)) * UNITS[match.group(2) or default_unit]
+
+
+def server_timings(response):
+    """Return the timings (name: milliseconds) reported by the server in *response*; unparseable ones are skipped."""
+    timings = {}
+    for metric in filter(None, response.headers.get('Server-Timing', '').split(',')):
+        name, *parameters = metric.strip().split(';')
+        for parameter in parameters:
+            key, _, value = parameter.strip().partition('=')
+            if key == 'dur':
+                timings[name] = milliseconds(value.strip('"'), 'ms')
+    if 'X-Response-Time' in response.headers:
+        timings['response-time'] = milliseconds(response.headers['X-Response-Time'], 'ms')
+    if 'X-Runtime' in response.headers:
+        timings['runtime'] = milliseconds(response.headers['X-Runtime'], 's')
+    return {name: value for name, value in timings.items() if value is not None}
+
+
+def parse_budgets(lines):
+    """Parse "METHOD PATH-PATTERN SECONDS" lines into [(method, pattern, seconds)]."""
+    budgets = []
+    for line in lines:
+        method, pattern, seconds = line.split()
+        budgets.append((method, pattern, float(seconds)))
+    return budgets
+
+
+class LatencyRecorder:
+    def __init__(self, config):
+        self.config = config
+        self.budgets = [] if config.getoption('ignore_latency_budgets') \
+            else parse_budgets(config.getoption('latency_budgets') or config.getini('latency_budgets'))
+        self.calls = []
+        self.nodeid = None
+        self.send = requests.Session.send
+        self.create_connection = urllib3.util.connection.create_connection
+
+    def install(self):
+        recorder = self
+
+        def send(session, request, **kwargs):
+            connection_times.dns = connection_times.connect = 0.0
+            started = time.perf_counter()
+            response = recorder.send(session, request, **kwargs)
+            recorder.record(request, response, time.perf_counter() - started)
+            return response
+
+        def create_connection(address, *args, **kwargs):
+            host, port = address
+            # Like urllib3: IPv6 literals come in brackets, and the address family depends on IPv6 support
+            if host.startswith('['):
+                host = host.strip('[]')
+            started = time.perf_counter()
+            addresses = socket.getaddrinfo(host, port, urllib3.util.connection.allowed_gai_family(),
+                                           socket.SOCK_STREAM)
+            resolved = time.perf_counter()
+            failure = OSError('getaddrinfo returns an empty list')
+            for *_, sockaddr in addresses:
+                try:
+                    sock = recorder.create_connection((sockaddr[0], port), *args, **kwargs)
+                except OSError as error:
+                    failure = error
+                    continue
+                connection_times.dns = resolved - started
+                connection_times.connect = time.perf_counter() - resolved
+                return sock
+            raise failure
+
+        requests.Session.send = send
+        urllib3.util.connection.create_connection = create_connection
+
+    def uninstall(self):
+        requests.Session.send = self.send
+        urllib3.util.connection.create_connection = self.create_connection
+
+    def record(self, request, response, total):
+        dns = getattr(connection_times, 'dns', 0.0)
+        connect = getattr(connection_times, 'connect', 0.0)
+        elapsed = response.elapsed.total_seconds()
+        call = Call(self.nodeid, request.method, request.url, response.status_code,
+                    dns, connect, max(0.0, elapsed - dns - connect), max(0.0, total - elapsed),
+                    server_timings(response))
+        for method, pattern, seconds in self.budgets:
+            if fnmatch.fnmatch(call.method, method) and fnmatch.fnmatch(call.path, pattern):
+                call.budget = seconds
+                break
+        self.calls.append(call)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        self.nodeid = item.nodeid
+        yield
+        self.nodeid = None
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        report = outcome.get_result()
+        if report.when != 'call' or not report.passed:
+            return
+        over_budget = [call for call in self.calls if call.nodeid == item.nodeid and call.over_budget]
+        if over_budget:
+            report.outcome = 'failed'
+            report.longrepr = 'Latency budget exceeded:\n' + '\n'.join(map(str, over_budget))
+
+    def pytest_sessionfinish(self, session):
+        path = self.config.getoption('latency_report')
+        if path:
+            with open(path, 'w') as file:
+                json.dump([call.as_dict() for call in self.calls], file, indent=1)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        top = self.config.getoption('latency_top')
+        if not top or not self.calls:
+            return
+        terminalreporter.write_sep('=', 'slowest {} HTTP requests'.format(min(top, len(self.calls))))
+        for call in sorted(self.calls, key=lambda call: call.total, reverse=True)[:top]:
+            terminalreporter.write_line('{}  {}'.format(call, call.nodeid))
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('latency', 'HTTP request latency')
+    group.addoption('--latency-top', type=int, default=10,
+                    help='Number of slowest HTTP requests to report (0: none)')
+    group.addoption('--latency-report', metavar='PATH',
+                    help='Write the timings of all HTTP requests as JSON to PATH')
+    group.addoption('--latency-budget', action='append', dest='latency_budgets', metavar='"METHOD PATTERN SECONDS"',
+                    help='Latency budget of the matching requests, instead of the ini option latency_budgets '
+                         '(repeatable, first match applies)')
+    group.addoption('--ignore-latency-budgets', action='store_true', default=False,
+                    help='Do not fail tests whose HTTP requests exceed their latency budget')
+    parser.addini('latency_budgets', type='linelist', default=[],
+                  help='Latency budgets, one "METHOD PATH-PATTERN SECONDS" per line (first match applies)')
+
+
+def pytest_configure(config):
+    recorder = LatencyRecorder(config)
+    recorder.install()
+    config.pluginmanager.register(recorder, 'latency-recorder')
+
+
+def pytest_unconfigure(config):
+    recorder = config.pluginmanager.get_plugin('latency-recorder')
+    if recorder:
+        recorder.uninstall()
+        config.pluginmanager.unregister(recorder)
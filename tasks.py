@@ -1,14 +1,14 @@
 
 import concurrent.futures
+import copy
 import signal
 import sys
-from tempfile import NamedTemporaryFile
 from functools import partial
 from pathlib import Path
 
 from invoke import Collection, Executor, Failure, task, run
+from invoke.config import merge_dicts
 from invoke.util import cd
-from invoke.vendor.yaml3 import dump
 
 import colorama
 colorama.init()
@@ -16,6 +16,12 @@ from termcolor import cprint, colored
 
 import tasks_servers
 import tasks_docker
+import tasks_scale
+import tasks_proxy
+import tasks_bench
+import tasks_seed
+import tasks_config
+import tasks_parallel
 
 try:
     # We import the tasks module of the applications via 'applications.XXX.tasks'; this extends the path so as to allow
@@ -75,8 +81,13 @@ def invoke_deploy_task(config_name, app, task):
             raise
 
 
-@task(pre=[tasks_servers.start_all])
-def deploy(ctx):
+@task(
+    pre=[tasks_servers.start_all],
+    help={
+        'which': 'Testing environment (see config) whose configuration overrides are deployed. Default: adhoc.',
+    },
+)
+def deploy(ctx, which='adhoc'):
     def monitor_progress(futures, num_futures):
         mikado = ["._.", "._o", "o_O", "O_O", "O_o", "o_."]
         completed = 0
@@ -103,45 +114,75 @@ def deploy(ctx):
             future.continue_dependent = partial(submit, config_name, executor, app, tasks)
             return [future]
         return []
-    with NamedTemporaryFile('w', suffix='.yaml') as config:
-        # Dump current contexts' configuration into temporary YAML
-        # file and use that as explicit runtime configuration for the
-        # deployment tasks (which run in PPE worker processes).
-        dump(ctx.config._collection, config)
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            futures = []
-            total_number_of_tasks = 0
-            for app in APPS:
-                deploy_tasks = APPS[app]
-                total_number_of_tasks += len(deploy_tasks)
-                futures += submit(config.name, executor, app, deploy_tasks)
-            monitor_progress(futures, total_number_of_tasks)
+    testenv = getattr(ctx.qabel.testing, which)
+    # Compile each application's slice of the current contexts' configuration
+    # into a JSON file and use that as explicit runtime configuration for its
+    # deployment tasks (which run in PPE worker processes).
+    collection = copy.deepcopy(ctx.config._collection)
+    merge_dicts(collection['qabel'], copy.deepcopy(testenv.get('overrides', {})))
+    for removed in testenv.get('remove', []):
+        *parents, key = removed.split('.')
+        section = collection['qabel']
+        for parent in parents:
+            section = section.get(parent, {})
+        section.pop(key, None)
+    if testenv.get('s3_server', False):
+        # Point block at the S3 stand-in started by "inv start"
+        collection['qabel']['block']['s3-bucket'] = ctx.qabel.testing.s3_bucket
+        collection['qabel']['block']['s3-endpoint-url'] = tasks_servers.S3_URL
+    configs, errors = tasks_config.compile_apps(collection, [Path(app).name for app in APPS])
+    if errors:
+        cprint('Invalid configuration:', 'red', attrs=['bold'])
+        for error in errors:
+            cprint('  - ' + error, 'red')
+        sys.exit(1)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        futures = []
+        total_number_of_tasks = 0
+        for app in APPS:
+            deploy_tasks = APPS[app]
+            total_number_of_tasks += len(deploy_tasks)
+            futures += submit(str(configs[Path(app).name]), executor, app, deploy_tasks)
+        monitor_progress(futures, total_number_of_tasks)
 
 
 @task(
-    pre=[deploy],
     help={
         'quiet': 'Smother uWSGI log output',
+        'which': 'Testing environment (see config) defining the layout. Default: adhoc.',
     },
 )
-def start(ctx, background=False, quiet=False):
+def start(ctx, background=False, quiet=False, which='adhoc'):
     """
     Run server with uWSGI.
 
     Note: an explicit "stop" is only needed when run in the background (-b, --background)
           otherwise everything terminates on ^C (SIGINT).
     """
+    testenv = getattr(ctx.qabel.testing, which)
     pidfile = Path(ctx.qabel.testing.app_data) / 'uwsgi.pid'
     pidfile.parent.mkdir(exist_ok=True, parents=True)
+    # Checked before deploying, which would switch the running servers to this environment's configuration.
     if tasks_servers.pidfile_alive(pidfile):
         print_bold('uWSGI is already running -- killable with "inv stop"')
         return False
+    # Executed like this (instead of as a pre-task) so the deployment gets the configuration of the environment.
+    Executor(namespace, ctx.config).execute(('deploy', {'which': which}))
+    env = {}
+    if testenv.get('s3_server', False):
+        print_bold('Starting S3 server')
+        tasks_servers.start_s3(ctx)
+        env.update(tasks_servers.S3_ENV)
+    if testenv.get('proxy', False):
+        print_bold('Starting proxy')
+        tasks_proxy.start_proxy(ctx, APPS, testenv)
     print_bold('Starting uWSGI')
     command_line = [
         'uwsgi',
         '--pidfile', pidfile,
-        '--emperor', '"applications/*/deployed/current/uwsgi.ini"',
     ]
+    for vassals in tasks_scale.emperor_globs(ctx, APPS, testenv.get('scale', {})):
+        command_line += '--emperor', '"' + vassals + '"'
     if quiet:
         command_line.append('--logto /dev/null')
     if background:
@@ -149,7 +190,18 @@ def start(ctx, background=False, quiet=False):
     command_line = ' '.join(map(str, command_line))
     print_bold('uWSGI command line:')
     print_bold(command_line)
-    run(command_line)
+    try:
+        run(command_line, env=env)
+    finally:
+        if not background:
+            tasks_proxy.stop_proxy(ctx)
+    if background and testenv.get('s3_server', False):
+        if not tasks_bench.check_s3_storage(ctx, testenv):
+            cprint('Uploaded blocks do not end up in the S3 stand-in (see {})'.format(tasks_servers.S3_URL),
+                   'red', attrs=['bold'])
+            Executor(namespace, ctx.config).execute(('stop', {}))
+            sys.exit(1)
+        print_bold('Uploads land in the S3 stand-in')
     return True
 
 
@@ -157,6 +209,7 @@ def start(ctx, background=False, quiet=False):
 def stop(ctx):
     pidfile = Path(ctx.qabel.testing.app_data) / 'uwsgi.pid'
     tasks_servers.kill_pidfile(pidfile, signal.SIGINT)
+    tasks_proxy.stop_proxy(ctx)
 
 
 @task(pre=[tasks_servers.status])
@@ -166,41 +219,78 @@ def status(ctx):
         print('uWSGI is started, emperor PID', uwsgi_pidfile.read_text().strip())
     else:
         print('uWSGI is stopped')
+    tasks_proxy.proxy_status(ctx)
 
 
 @task(
     help={
         'pytest_args': 'Additional arguments passed to py.test',
-        'which': 'Testing environment (see config). Default: adhoc.',
+        'which': 'Testing environment(s), comma-separated (see config). Default: adhoc.',
         'quiet': 'Smother uWSGI log output',
     }
 )
 def test(ctx, pytest_args='', which='adhoc', quiet=False):
     """
     Run the test suite against ad-hoc created infrastructure.
+
+    Several environments (e.g. -w adhoc,docker,testing) are tested concurrently, see app-data/test-reports.
     """
-    testenv = getattr(ctx.qabel.testing, which)
-    start_servers = testenv.get('start_servers', False)
+    environments = which.split(',')
+    started_by_us = [env for env in environments if getattr(ctx.qabel.testing, env).get('start_servers', False)]
+    if len(started_by_us) > 1:
+        cprint('Only one of the environments can start servers, not all of ' + ', '.join(started_by_us), 'red')
+        sys.exit(1)
+    start_servers = bool(started_by_us)
     pallin = Executor(namespace, ctx.config)
     if start_servers:
         # For correct resolution of pre/post tasks this is needed, a bit ugly but oh well.
         result = pallin.execute(
-            ('start', {'background': True, 'quiet': quiet})
+            ('start', {'background': True, 'quiet': quiet, 'which': started_by_us[0]})
         )
         start_servers = result[start]  # only stop them if we actually had to start them
-    command_line = ['py.test']
-    for app in APPS:
-        *_, app = app.split('/')
-        app_url = '--{app}-url {url}'.format(app=app, url=testenv[app])
-        command_line.append(app_url)
-    command_line.append(pytest_args)
-    command_line = ' '.join(command_line)
-    print_bold(command_line)
+    command_lines = {}
+    for env in environments:
+        testenv = getattr(ctx.qabel.testing, env)
+        command_line = ['py.test']
+        for app in APPS:
+            *_, app = app.split('/')
+            app_url = '--{app}-url {url}'.format(app=app, url=testenv[app])
+            command_line.append(app_url)
+        for budget in testenv.get('latency_budgets', []):
+            command_line.append("--latency-budget '{}'".format(budget))
+        command_line.append(pytest_args)
+        command_lines[env] = ' '.join(command_line)
+        print_bold(command_lines[env])
     try:
-        ctx.run(command_line, pty=True)
+        if len(environments) == 1:
+            ctx.run(command_lines[which], pty=True)
+            passed = True
+        else:
+            passed = tasks_parallel.run_environments(Path(ctx.qabel.testing.app_data) / 'test-reports', command_lines)
     finally:
         if start_servers:
             pallin.execute(('stop', {}))
+    if not passed:
+        sys.exit(1)
+
+
+@task(
+    pre=[tasks_servers.start_all],
+    help={
+        'scale': 'Number of users',
+        'seed': 'Random seed; the same seed always yields the same dataset',
+        'blocks': 'Number of blocks per user',
+        'messages': 'Number of drop messages per user',
+        'which': 'Testing environment (see config) whose drop URL the seeded identities use. Default: adhoc.',
+    }
+)
+def seed(ctx, scale=1000, seed=0, blocks=20, messages=5, which='adhoc'):
+    """
+    Load a generated, reproducible dataset into all databases.
+    """
+    print_bold('Seeding {} users (seed {})'.format(scale, seed))
+    if not tasks_seed.seed_all(scale, seed, blocks, messages, getattr(ctx.qabel.testing, which).drop):
+        sys.exit(1)
 
 
 @task
@@ -221,11 +311,16 @@ def update(ctx):
             run('git pull --ff-only')
 
 
-namespace = Collection(deploy, start, stop, status, test, update, tasks_servers.servers, tasks_docker.docker)
+namespace = Collection(deploy, start, stop, status, test, seed, update, tasks_servers.servers, tasks_docker.docker,
+                       tasks_bench.bench)
 if not HAVE_APPS:
     namespace = Collection(update)
 
 # Load configuration explicitly
-for app in APPS:
-    assert try_load(Path(app) / 'defaults.yaml', namespace)
-assert try_load(Path(__file__).with_name('defaults.yaml'), namespace)
+tasks_config.load_defaults(
+    namespace,
+    [Path(app) / 'defaults.yaml' for app in APPS] + [Path(__file__).with_name('defaults.yaml')],
+    try_load,
+    # Without the applications try_load is a stand-in, whose result must not be cached
+    cache=HAVE_APPS,
+)
@@ -0,0 +1,242 @@
+
+"""
+Benchmarks against running testing environments.
+
+The servers of the environment must already be running (e.g. "inv start -b -w proxied"). Results are stored
+per benchmark and environment under app-data/bench, and every run prints the stored results of all environments
+side by side.
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from termcolor import cprint
+
+from invoke import Collection, task
+
+import tasks_servers
+
+COLUMNS = [
+    ('ops/s', 'ops_per_second', '{:.1f}'),
+    ('MB/s', 'mb_per_second', '{:.2f}'),
+    ('p50 ms', 'p50', '{:.1f}'),
+    ('p90 ms', 'p90', '{:.1f}'),
+    ('p99 ms', 'p99', '{:.1f}'),
+    ('max ms', 'max', '{:.1f}'),
+]
+
+
+def percentile(latencies, p):
+    """Return the *p*th percentile of the sorted *latencies*."""
+    index = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+    return latencies[index]
+
+
+def summarize(latencies, elapsed, nbytes):
+    """Summarize the *latencies* (seconds) of operations transferring *nbytes* in *elapsed* seconds."""
+    latencies = sorted(latencies)
+    return {
+        'operations': len(latencies),
+        'ops_per_second': len(latencies) / elapsed,
+        'mb_per_second': nbytes / elapsed / 2**20,
+        'p50': percentile(latencies, 50) * 1000,
+        'p90': percentile(latencies, 90) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'max': latencies[-1] * 1000,
+    }
+
+
+def measure(operation, items, concurrency):
+    """
+    Call *operation(session, item)* for all *items* using *concurrency* threads, each with its own
+    (keep-alive) session. *operation* returns the number of bytes transferred. Return the summary.
+    """
+    local = threading.local()
+
+    def timed(item):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        nbytes = operation(local.session, item)
+        return time.perf_counter() - started, nbytes
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed, items))
+    elapsed = time.perf_counter() - started
+    return summarize([latency for latency, _ in results], elapsed, sum(nbytes for _, nbytes in results))
+
+
+def bench_path(ctx, benchmark, which):
+    return Path(ctx.qabel.testing.app_data) / 'bench' / '{}-{}.json'.format(benchmark, which)
+
+
+def save_results(ctx, benchmark, which, results):
+    path = bench_path(ctx, benchmark, which)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with path.open('w') as file:
+        json.dump(results, file, indent=4)
+
+
+def print_comparison(ctx, benchmark):
+    """Print the stored *benchmark* results of all environments side by side."""
+    stored = {}
+    for path in sorted(bench_path(ctx, benchmark, '*').parent.glob(benchmark + '-*.json')):
+        with path.open() as file:
+            stored[path.stem[len(benchmark) + 1:]] = json.load(file)
+    header = '{:<24}{:<12}'.format('', 'env') + ''.join('{:>10}'.format(title) for title, *_ in COLUMNS)
+    cprint(header, attrs=['bold'])
+    scenarios = sorted({scenario for results in stored.values() for scenario in results})
+    for scenario in scenarios:
+        for which, results in stored.items():
+            if scenario not in results:
+                continue
+            line = '{:<24}{:<12}'.format(scenario, which)
+            for _, key, fmt in COLUMNS:
+                line += '{:>10}'.format(fmt.format(results[scenario][key]))
+            print(line)
+
+
+def login(session, testenv, accounting_user):
+    response = session.post(testenv['accounting'] + 'api/v0/auth/login/', json=accounting_user)
+    response.raise_for_status()
+    return {'Authorization': 'Token ' + response.json()['key']}
+
+
+def create_prefix(session, testenv, headers):
+    response = session.post(testenv['block'] + 'api/v0/prefix/', headers=headers)
+    response.raise_for_status()
+    return response.json()['prefix']
+
+
+def block_urls(testenv, prefix, number):
+    return [testenv['block'] + 'api/v0/files/{}/blocks/{}'.format(prefix, uuid.uuid4()) for _ in range(number)]
+
+
+def random_bytes(size):
+    return random.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def upload_blocks(session, testenv, headers, prefix, number, size):
+    """Upload *number* random blocks of *size* bytes and return their URLs."""
+    urls = block_urls(testenv, prefix, number)
+    for url in urls:
+        session.post(url, headers=headers, data=random_bytes(size)).raise_for_status()
+    return urls
+
+
+def uploader(headers, data):
+    """Return an operation (see measure) uploading *data* to the URL it is given."""
+    def upload(session, url):
+        session.post(url, headers=headers, data=data).raise_for_status()
+        return len(data)
+    return upload
+
+
+def download(session, url):
+    response = session.get(url)
+    response.raise_for_status()
+    return len(response.content)
+
+
+def check_s3_storage(ctx, testenv, timeout=30):
+    """
+    Upload a block to the block server of *testenv* (waiting up to *timeout* seconds for it to come up) and
+    return whether it landed in the S3 stand-in.
+    """
+    accounting_user = {'username': 'testuser', 'password': 'testuser'}
+    session = requests.Session()
+    for i in range(timeout):
+        try:
+            headers = login(session, testenv, accounting_user)
+        except requests.RequestException:
+            time.sleep(1)
+        else:
+            break
+    else:
+        return False
+    try:
+        url, = upload_blocks(session, testenv, headers, create_prefix(session, testenv, headers), 1, 2**10)
+        block_name = url.rpartition('/')[2]
+        return any(key.endswith(block_name) for key in tasks_servers.s3_keys(ctx))
+    except requests.RequestException:
+        return False
+
+
+@task(
+    help={
+        'which': 'Testing environment(s), comma-separated (see config). Default: adhoc.',
+        'downloads': 'Number of block downloads',
+        'blocks': 'Number of distinct blocks downloaded',
+        'size': 'Size of a block in bytes',
+        'concurrency': 'Number of concurrent clients',
+    }
+)
+def block(ctx, which='adhoc', downloads=2000, blocks=50, size=256 * 1024, concurrency=8):
+    """
+    Benchmark downloads of immutable blocks, e.g. with and without the proxy (-w adhoc,proxied).
+    """
+    accounting_user = {'username': 'testuser', 'password': 'testuser'}
+    for env in which.split(','):
+        testenv = getattr(ctx.qabel.testing, env)
+        cprint('Benchmarking block downloads ({})'.format(env), attrs=['bold'])
+        session = requests.Session()
+        headers = login(session, testenv, accounting_user)
+        prefix = create_prefix(session, testenv, headers)
+        urls = upload_blocks(session, testenv, headers, prefix, blocks, size)
+        # First round warms caches along the way, the second one is what clients see for popular blocks.
+        results = {
+            'download (cold)': measure(download, urls, concurrency),
+            'download (warm)': measure(download, [random.choice(urls) for _ in range(downloads)], concurrency),
+        }
+        save_results(ctx, 'block', env, results)
+    print_comparison(ctx, 'block')
+
+
+@task(
+    help={
+        'which': 'Testing environment(s), comma-separated (see config). Default: adhoc.',
+        'small': 'Number of small (1 KiB) files uploaded and downloaded',
+        'large': 'Number of large (4 MiB) files uploaded and downloaded',
+        'multipart': 'Number of multipart-sized (16 MiB) files uploaded and downloaded concurrently',
+        'concurrency': 'Number of concurrent clients',
+    }
+)
+def storage(ctx, which='adhoc', small=1000, large=50, multipart=16, concurrency=8):
+    """
+    Benchmark the block storage backend, e.g. local storage (-w adhoc) and S3 (-w s3).
+    """
+    accounting_user = {'username': 'testuser', 'password': 'testuser'}
+    sizes = [
+        ('small', 2**10, small, concurrency),
+        ('large', 4 * 2**20, large, 1),
+        ('multipart', 16 * 2**20, multipart, concurrency),
+    ]
+    for env in which.split(','):
+        testenv = getattr(ctx.qabel.testing, env)
+        cprint('Benchmarking block storage ({})'.format(env), attrs=['bold'])
+        if testenv.get('s3_server', False) and not check_s3_storage(ctx, testenv):
+            cprint('{}: uploaded blocks do not end up in the S3 stand-in, not benchmarking'.format(env),
+                   'red', attrs=['bold'])
+            continue
+        session = requests.Session()
+        headers = login(session, testenv, accounting_user)
+        prefix = create_prefix(session, testenv, headers)
+        results = {}
+        for name, size, number, clients in sizes:
+            urls = block_urls(testenv, prefix, number)
+            results['upload ' + name] = measure(uploader(headers, random_bytes(size)), urls, clients)
+            results['download ' + name] = measure(download, urls, clients)
+        save_results(ctx, 'storage', env, results)
+    print_comparison(ctx, 'storage')
+
+
+bench = Collection('bench')
+bench.add_task(block)
+bench.add_task(storage)
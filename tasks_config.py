@@ -0,0 +1,188 @@
+
+"""
+Compiled configuration: merged defaults and per-application deployment configuration as JSON.
+
+Parsing and merging the YAML files of all applications happens once per version of these files; afterwards the
+merged result is loaded from JSON. Deployments receive only their application's slice of the configuration
+(with YAML merges like "<<: *django_psql" already expanded), validated against SCHEMA before anything starts.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from invoke import Collection
+
+COMPILED = Path(__file__).absolute().with_name('.compiled-config')
+
+
+def digest(*parts):
+    return hashlib.sha256(b'\0'.join(parts)).hexdigest()[:16]
+
+
+def write_compiled(name, data):
+    """Write *data* to COMPILED/<name>-<digest of data>.json (if not there yet) and return its path."""
+    content = json.dumps(data, sort_keys=True, indent=1).encode()
+    path = COMPILED / '{}-{}.json'.format(name, digest(content))
+    if not path.exists():
+        write_atomically(path, content)
+    return path
+
+
+def write_atomically(path, content):
+    """
+    Write *content* to *path* (in COMPILED) via a temporary file, so concurrent readers and writers never see
+    partial files. Other versions are left alone, they may still be in use.
+    """
+    COMPILED.mkdir(exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=str(COMPILED), suffix='.tmp', delete=False) as temporary:
+        temporary.write(content)
+    os.replace(temporary.name, str(path))
+
+
+def load_defaults(namespace, paths, try_load, cache=True):
+    """
+    Configure *namespace* with the YAML files *paths* (merged in order with *try_load*).
+
+    The merged configuration is cached as JSON, keyed by the contents of the files. Without *cache* (e.g. when
+    *try_load* is a stand-in for the real loader) nothing is written to the cache.
+    """
+    sources = []
+    for path in paths:
+        try:
+            sources += str(path).encode(), path.read_bytes()
+        except FileNotFoundError:
+            sources += str(path).encode(), b''
+    compiled = COMPILED / 'defaults-{}.json'.format(digest(*sources))
+    try:
+        with compiled.open() as file:
+            namespace.configure(json.load(file))
+        return
+    except (FileNotFoundError, ValueError):
+        pass
+    merged = Collection()
+    for path in paths:
+        assert try_load(path, merged)
+    configuration = merged.configuration()
+    if cache:
+        write_atomically(compiled, json.dumps(configuration).encode())
+    namespace.configure(configuration)
+
+
+def port(value):
+    if not isinstance(value, int) or not 0 < value < 65536:
+        raise ValueError('not a port number')
+
+
+def socket(value):
+    match = re.fullmatch(r'[\w.-]*:(\d+)', str(value))
+    if not match:
+        raise ValueError('not a socket like "[host]:port"')
+    port(int(match.group(1)))
+
+
+def url(value):
+    parts = urlsplit(str(value))
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        raise ValueError('not a HTTP URL')
+
+
+def dsn(value):
+    parts = urlsplit(str(value))
+    if parts.scheme not in ('postgres', 'postgresql') or not parts.path.strip('/'):
+        raise ValueError('not a PostgreSQL DSN with database name')
+    if parts.port is not None:
+        port(parts.port)
+
+
+def text(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError('not a non-empty string')
+
+
+DJANGO_DATABASES = {
+    'default': {
+        'ENGINE': text,
+        'NAME': text,
+        'USER': text,
+        'PORT': port,
+    },
+}
+
+UWSGI = {
+    'http-socket': socket,
+}
+
+# Required settings of the applications and their validators; validators raise ValueError for invalid values.
+SCHEMA = {
+    'block': {
+        'psql_dsn': dsn,
+        'redis-port': port,
+        'accounting-host': url,
+        'uwsgi': UWSGI,
+    },
+    'accounting': {
+        'DATABASES': DJANGO_DATABASES,
+        'uwsgi': UWSGI,
+    },
+    'drop': {
+        'DATABASES': DJANGO_DATABASES,
+        'uwsgi': UWSGI,
+    },
+    'index': {
+        'ACCOUNTING_URL': url,
+        'DATABASES': DJANGO_DATABASES,
+        'uwsgi': UWSGI,
+    },
+}
+
+
+def validate(schema, config, path):
+    """Validate *config* (at dotted *path*) against *schema*, return list of error messages."""
+    if not isinstance(config, dict):
+        return ['{}: missing'.format(path)]
+    errors = []
+    for key, validator in schema.items():
+        key_path = path + '.' + key
+        if isinstance(validator, dict):
+            errors += validate(validator, config.get(key), key_path)
+        elif key not in config:
+            errors.append('{}: missing'.format(key_path))
+        else:
+            try:
+                validator(config[key])
+            except ValueError as error:
+                errors.append('{}: {} ({!r})'.format(key_path, error, config[key]))
+    return errors
+
+
+def compile_apps(collection, names):
+    """
+    Validate the configuration of the applications *names* in *collection* and write each one's slice.
+
+    Return ({name: path of compiled slice}, list of error messages).
+    """
+    errors = []
+    sockets = {}
+    for name in names:
+        section = collection['qabel'].get(name)
+        errors += validate(SCHEMA.get(name, {}), section, 'qabel.' + name)
+        try:
+            sockets.setdefault(section['uwsgi']['http-socket'].rpartition(':')[2], []).append(name)
+        except (KeyError, TypeError, AttributeError):
+            pass
+    for socket_port, users in sorted(sockets.items()):
+        if len(users) > 1:
+            errors.append('port {} used by {}'.format(socket_port, ', '.join(users)))
+    if errors:
+        return {}, errors
+    compiled = {}
+    for name in names:
+        data = {key: value for key, value in collection.items() if key != 'qabel'}
+        data['qabel'] = {name: collection['qabel'][name]}
+        compiled[name] = write_compiled(name, data)
+    return compiled, []
@@ -0,0 +1,90 @@
+
+"""
+Running the test suite against several testing environments concurrently.
+
+Each environment gets its own py.test process, whose output goes to app-data/test-reports/<env>.log. Afterwards
+the JUnit XML reports are merged (merged.xml) and summarized, and the latencies of the endpoints (recorded by the
+pytest_latency plugin) are compared across environments.
+"""
+
+import json
+import statistics
+import subprocess
+import xml.etree.ElementTree as ET
+
+from termcolor import cprint
+
+
+def run_environments(reports, command_lines):
+    """
+    Run the py.test *command_lines* ({env: command line}) concurrently, writing reports to *reports*.
+
+    Return whether all of them passed.
+    """
+    reports.mkdir(exist_ok=True, parents=True)
+    processes = {}
+    for env, command_line in command_lines.items():
+        command_line += ' --junitxml {} --latency-report {}'.format(
+            reports / (env + '.xml'), reports / (env + '-latency.json'))
+        with (reports / (env + '.log')).open('w') as log:
+            processes[env] = subprocess.Popen(command_line, shell=True, stdout=log, stderr=subprocess.STDOUT)
+        print('{}: started, output in {}'.format(env, reports / (env + '.log')))
+    passed = True
+    for env, process in processes.items():
+        returncode = process.wait()
+        cprint('{}: finished ({})'.format(env, 'passed' if not returncode else 'failed'),
+               'green' if not returncode else 'red')
+        passed &= not returncode
+    summarize_results(reports, list(command_lines))
+    compare_latencies(reports, list(command_lines))
+    return passed
+
+
+def summarize_results(reports, environments):
+    """Merge the JUnit XML reports of *environments* into merged.xml and print a summary."""
+    merged = ET.Element('testsuites')
+    cprint('{:<16}{:>8}{:>8}{:>8}{:>8}{:>10}'.format('env', 'tests', 'failed', 'errors', 'skipped', 'time'),
+           attrs=['bold'])
+    failures = []
+    for env in environments:
+        try:
+            root = ET.parse(str(reports / (env + '.xml'))).getroot()
+        except (OSError, ET.ParseError):
+            cprint('{:<16}no report (see {}.log)'.format(env, env), 'red')
+            continue
+        for suite in root.iter('testsuite'):
+            suite.set('name', env)
+            for case in suite.iter('testcase'):
+                case.set('classname', env + '.' + case.get('classname', ''))
+                if case.find('failure') is not None or case.find('error') is not None:
+                    failures.append(case.get('classname') + '::' + case.get('name'))
+            merged.append(suite)
+            print('{:<16}{:>8}{:>8}{:>8}{:>8}{:>10}'.format(
+                env, suite.get('tests'), suite.get('failures'), suite.get('errors'), suite.get('skipped', 0),
+                suite.get('time')))
+    for failure in failures:
+        cprint('  failed: ' + failure, 'red')
+    ET.ElementTree(merged).write(str(reports / 'merged.xml'), encoding='utf-8', xml_declaration=True)
+
+
+def compare_latencies(reports, environments):
+    """Print the median latency (ms) of each endpoint in each of the *environments*."""
+    latencies = {}
+    for env in environments:
+        try:
+            with (reports / (env + '-latency.json')).open() as file:
+                calls = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for call in calls:
+            latencies.setdefault(call['endpoint'], {}).setdefault(env, []).append(call['total'] * 1000)
+    if not latencies:
+        return
+    width = max(map(len, latencies)) + 2
+    cprint('{:<{width}}'.format('median latency (ms)', width=width) +
+           ''.join('{:>12}'.format(env) for env in environments), attrs=['bold'])
+    for endpoint, per_env in sorted(latencies.items()):
+        line = '{:<{width}}'.format(endpoint, width=width)
+        for env in environments:
+            line += '{:>12}'.format('{:.1f}'.format(statistics.median(per_env[env])) if env in per_env else '-')
+        print(line)
@@ -0,0 +1,156 @@
+
+"""
+Optional reverse-proxy front (nginx) for the ad-hoc infrastructure.
+
+Each application gets a proxy server on the port of its URL in the testing environment, forwarding to the
+application's http-socket. The proxy keeps client and upstream connections alive, gzips JSON responses and
+caches GETs of blocks (<prefix>/blocks/...) of the block server. Cached blocks are revalidated with the block
+server (If-None-Match) on every request, so only the transfer of unchanged blocks is saved; deleted or replaced
+blocks are never served from the cache.
+"""
+
+import signal
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from invoke import run
+
+from tasks_scale import socket_port
+from tasks_servers import kill_pidfile, pidfile_alive
+
+NGINX_CONF = """
+daemon on;
+pid {pidfile};
+error_log {log};
+worker_processes auto;
+
+events {{
+    worker_connections 1024;
+}}
+
+http {{
+    access_log off;
+    client_body_temp_path {temp}/client-body;
+    proxy_temp_path {temp}/proxy;
+    fastcgi_temp_path {temp}/fastcgi;
+    uwsgi_temp_path {temp}/uwsgi;
+    scgi_temp_path {temp}/scgi;
+    client_max_body_size 0;
+
+    keepalive_timeout 65s;
+    keepalive_requests 1000;
+
+    gzip on;
+    gzip_proxied any;
+    gzip_types application/json;
+
+    proxy_http_version 1.1;
+    proxy_set_header Connection "";
+    proxy_set_header Host $http_host;
+
+    proxy_cache_path {cache} levels=1:2 keys_zone=blocks:10m max_size={cache_size} inactive={block_cache_inactive};
+{servers}}}
+"""
+
+NGINX_SERVER = """
+    upstream {name} {{
+        server {upstream};
+        keepalive 32;
+    }}
+
+    server {{
+        listen {port};
+
+        location / {{
+            proxy_pass http://{name};
+        }}{locations}
+    }}
+"""
+
+NGINX_BLOCK_CACHE = """
+        location ~ ^/api/v0/files/[^/]+/blocks/ {{
+            proxy_pass http://{name}-origin;
+            proxy_cache blocks;
+            proxy_cache_key $uri;
+            proxy_cache_revalidate on;
+            add_header X-Cache-Status $upstream_cache_status;
+        }}"""
+
+# The block cache reaches the block server through this server, which marks every response as expired
+# (X-Accel-Expires in the past). nginx still stores them, but has to revalidate them for every request.
+NGINX_BLOCK_ORIGIN = """
+    upstream {name}-origin {{
+        server unix:{socket};
+        keepalive 32;
+    }}
+
+    server {{
+        listen unix:{socket};
+
+        location / {{
+            proxy_pass http://{name};
+            add_header X-Accel-Expires @1 always;
+        }}
+    }}
+"""
+
+
+def proxy_path(ctx):
+    return Path(ctx.qabel.testing.app_data).absolute() / 'proxy'
+
+
+def write_config(ctx, apps, testenv):
+    """Write the nginx configuration for proxying *apps* on the ports of *testenv* and return its path."""
+    path = proxy_path(ctx)
+    settings = ctx.qabel.testing.proxy
+    servers = []
+    for app in apps:
+        name = Path(app).name
+        socket = getattr(ctx.qabel, name).uwsgi['http-socket']
+        locations = ''
+        if name == 'block':
+            locations = NGINX_BLOCK_CACHE.format(name=name)
+            servers.append(NGINX_BLOCK_ORIGIN.format(name=name, socket=path / (name + '-origin.sock')))
+        servers.append(NGINX_SERVER.format(
+            name=name,
+            upstream='127.0.0.1:{}'.format(socket_port(socket)),
+            port=urlsplit(testenv[name]).port,
+            locations=locations,
+        ))
+    (path / 'temp').mkdir(exist_ok=True, parents=True)
+    config = path / 'nginx.conf'
+    config.write_text(NGINX_CONF.format(
+        pidfile=path / 'nginx.pid',
+        log=path / 'error.log',
+        temp=path / 'temp',
+        cache=path / 'cache',
+        cache_size=settings.cache_size,
+        block_cache_inactive=settings.block_cache_inactive,
+        servers=''.join(servers),
+    ))
+    return config
+
+
+def start_proxy(ctx, apps, testenv):
+    path = proxy_path(ctx)
+    if pidfile_alive(path / 'nginx.pid'):
+        print('proxy is running')
+        return
+    config = write_config(ctx, apps, testenv)
+    run('{nginx} -p {prefix} -c {config}'.format(nginx=ctx.qabel.testing.nginx, prefix=path, config=config))
+    print('proxy started')
+
+
+def stop_proxy(ctx):
+    pidfile = proxy_path(ctx) / 'nginx.pid'
+    if pidfile_alive(pidfile):
+        # nginx removes its pidfile itself on a graceful shutdown (SIGQUIT)
+        kill_pidfile(pidfile, signal.SIGQUIT, unlink=False)
+
+
+def proxy_status(ctx):
+    pidfile = proxy_path(ctx) / 'nginx.pid'
+    if pidfile_alive(pidfile):
+        print('proxy is started, PID', pidfile.read_text().strip())
+    else:
+        print('proxy is stopped')
@@ -0,0 +1,134 @@
+
+"""
+Scaled uWSGI layout: several instances of an application behind a local load-balancing front.
+
+Every instance is a copy of the application's deployed uwsgi.ini (placed next to it, so relative paths
+keep working), with the http-socket replaced by a uwsgi-protocol socket on a generated port. The application's
+usual http-socket port is then served by a uWSGI HTTP router vassal which distributes requests round-robin
+across the instances.
+"""
+
+import re
+import shutil
+import sys
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from termcolor import cprint
+
+from tasks_servers import PGSQL_SUFFIX, REDIS_PORT, S3_PORT
+
+HTTP_SOCKET = re.compile(r'^\s*http-socket\s*=.*$', re.MULTILINE)
+
+INSTANCE_GLOB = 'uwsgi-instance-*.ini'
+
+
+def socket_port(socket):
+    """Return the port of an uWSGI socket spec like ':9697' or 'localhost:9697'."""
+    *_, port = socket.rpartition(':')
+    return int(port)
+
+
+def instance_ports(port, instances, step):
+    """Return the ports of *instances* instances of an application usually listening on *port*."""
+    return [port + step * n for n in range(1, instances + 1)]
+
+
+def write_instances(deployed, ports):
+    """Write one vassal per port in *ports* next to the *deployed* uwsgi.ini."""
+    for stale in deployed.parent.glob(INSTANCE_GLOB):
+        stale.unlink()
+    ini = deployed.read_text()
+    if not HTTP_SOCKET.search(ini):
+        cprint('{}: no http-socket found, cannot scale this application'.format(deployed), 'red', attrs=['bold'])
+        sys.exit(1)
+    for n, port in enumerate(ports, 1):
+        instance = HTTP_SOCKET.sub('socket = 127.0.0.1:{}'.format(port), ini)
+        (deployed.parent / INSTANCE_GLOB.replace('*', str(n))).write_text(instance)
+
+
+def write_router(path, socket, ports):
+    """Write an uWSGI HTTP router vassal listening on *socket* and balancing over *ports*."""
+    lines = [
+        '[uwsgi]',
+        'master = true',
+        'http = ' + socket,
+    ]
+    lines += ['http-to = 127.0.0.1:{}'.format(port) for port in ports]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def used_ports(ctx, apps):
+    """
+    Return {port: user} of the ports used besides scaled instances: the servers, the applications' http-sockets
+    and the local ports of all testing environments (e.g. those of the reverse proxy).
+    """
+    ports = {PGSQL_SUFFIX: 'postgres', REDIS_PORT: 'redis', S3_PORT: 's3'}
+    for app in apps:
+        name = Path(app).name
+        ports.setdefault(socket_port(getattr(ctx.qabel, name).uwsgi['http-socket']), name)
+    for env, testenv in ctx.qabel.testing.items():
+        if not isinstance(testenv, dict):
+            continue
+        for name, url in testenv.items():
+            try:
+                parts = urlsplit(url)
+                port = parts.port
+            except (TypeError, AttributeError, ValueError):
+                continue
+            if parts.hostname in ('localhost', '127.0.0.1') and port:
+                ports.setdefault(port, '{} ({} environment)'.format(name, env))
+    return ports
+
+
+def check_ports(ctx, apps, instances):
+    """Check the *instances* ({app name: ports}) against each other and used_ports, return list of errors."""
+    used = used_ports(ctx, apps)
+    errors = []
+    for name, ports in sorted(instances.items()):
+        for n, port in enumerate(ports, 1):
+            user = used.setdefault(port, '{} instance {}'.format(name, n))
+            if user != '{} instance {}'.format(name, n):
+                errors.append('{} instance {}: port {} already used by {}'.format(name, n, port, user))
+    return errors
+
+
+def emperor_globs(ctx, apps, scale):
+    """
+    Prepare the vassals for *scale* ({app name: number of instances}) and return the emperor globs to run.
+
+    Applications not mentioned in *scale* (or scaled to one instance) run their plain deployed uwsgi.ini.
+    """
+    routers = Path(ctx.qabel.testing.app_data) / 'scaled'
+    shutil.rmtree(str(routers), ignore_errors=True)
+    step = ctx.qabel.testing.scale_port_step
+    instances = {}
+    for app in apps:
+        name = Path(app).name
+        if scale.get(name, 1) > 1:
+            socket = getattr(ctx.qabel, name).uwsgi['http-socket']
+            instances[name] = instance_ports(socket_port(socket), scale[name], step)
+    errors = check_ports(ctx, apps, instances)
+    if errors:
+        for error in errors:
+            cprint(error, 'red', attrs=['bold'])
+        cprint('Change the scale of the environment or qabel.testing.scale_port_step', 'red')
+        sys.exit(1)
+    globs = []
+    for app in apps:
+        name = Path(app).name
+        deployed = Path(app) / 'deployed' / 'current' / 'uwsgi.ini'
+        if name not in instances:
+            globs.append(str(deployed))
+            continue
+        socket = getattr(ctx.qabel, name).uwsgi['http-socket']
+        ports = instances[name]
+        write_instances(deployed, ports)
+        routers.mkdir(exist_ok=True, parents=True)
+        write_router(routers / (name + '.ini'), socket, ports)
+        globs.append(str(deployed.with_name(INSTANCE_GLOB)))
+        cprint('{name}: {n} instances on ports {ports}'.format(name=name, n=len(ports),
+                                                               ports=', '.join(map(str, ports))), attrs=['bold'])
+    if routers.exists():
+        globs.append(str(routers / '*.ini'))
+    return globs
@@ -0,0 +1,356 @@
+
+"""
+Bulk seeding of the ad-hoc databases with reproducible datasets.
+
+Every dataset is generated from a random seed, so the rows of the four databases are consistent with each other
+(the owners of block prefixes are accounting users and stay within their quota, index identities use their e-mail
+addresses and point at the drops of their messages, ...), and the same seed always yields the same dataset. Rows are
+loaded with COPY, one process per database.
+
+Seeded blocks are metadata only: the files table gets their sizes (adding up to the owners' usage), but no contents
+are written to the storage backend, so downloading them fails with 404.
+
+Seeded rows use ids (and user ids) from SEED_ID_BASE on, so fixtures like "testuser" are left alone. Every database
+records the parameters of its last seeding in the seed_marker table; seeding again deletes exactly the rows of that
+dataset. The id sequences of the tables are not touched: ids in the seeded range that are in use by other rows, or
+sequences that have reached it, make seeding fail instead.
+"""
+
+import base64
+import concurrent.futures
+import hashlib
+import io
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import psycopg2
+from termcolor import cprint
+
+from tasks_servers import PGSQL_SUFFIX
+
+SEED_ID_BASE = 1000000
+
+# Every seeded user has this password
+SEED_PASSWORD = 'VeryHighEntropyPassphraseFactory'
+
+# Rows are sent to the server in batches of this many rows
+COPY_BATCH = 10000
+
+EPOCH = datetime(2016, 1, 1)
+
+QUOTAS = [2 * 2**30, 5 * 2**30, 100 * 2**30]
+
+
+class SeedError(Exception):
+    pass
+
+
+def django_password(password, rng, iterations=24000):
+    """Hash *password* like Django's PBKDF2PasswordHasher does."""
+    salt = '%012x' % rng.getrandbits(48)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return 'pbkdf2_sha256${}${}${}'.format(iterations, salt, base64.b64encode(digest).decode())
+
+
+class Dataset:
+    """
+    The users of a dataset and everything they own, generated lazily from *seed*.
+
+    Each kind of data has its own random stream, so e.g. the block rows don't depend on how many drop messages
+    there are per user.
+    """
+
+    def __init__(self, scale, seed, blocks, messages, drop_url=None):
+        self.scale = scale
+        self.seed = seed
+        self.blocks = blocks
+        self.messages = messages
+        self.drop_url = drop_url
+
+    def rng(self, kind):
+        return random.Random('{}-{}'.format(self.seed, kind))
+
+    def timestamp(self, rng):
+        return EPOCH + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+
+    def user_ids(self):
+        return range(SEED_ID_BASE, SEED_ID_BASE + self.scale)
+
+    def message_ids(self):
+        return range(SEED_ID_BASE, SEED_ID_BASE + self.scale * self.messages)
+
+    def users(self):
+        rng = self.rng('users')
+        password = django_password(SEED_PASSWORD, rng)
+        for n in range(self.scale):
+            yield {
+                'id': self.user_ids()[n],
+                'username': 'seed-{}'.format(n),
+                'email': 'seed-{}@example.net'.format(n),
+                'password': password,
+                'token': '%040x' % rng.getrandbits(160),
+                'quota': rng.choice(QUOTAS),
+                'joined': self.timestamp(rng),
+            }
+
+    def prefixes(self):
+        rng = self.rng('prefixes')
+        for user in self.users():
+            yield user, str(uuid.UUID(int=rng.getrandbits(128)))
+
+    def user_blocks(self):
+        """Yield (user, prefix, file path, size) of the blocks of all users, which stay within their quota."""
+        rng = self.rng('blocks')
+        for user, prefix in self.prefixes():
+            free = user['quota']
+            for _ in range(self.blocks):
+                size = min(int(rng.lognormvariate(10, 2)), 2**30, free)
+                free -= size
+                yield user, prefix, 'blocks/' + str(uuid.UUID(int=rng.getrandbits(128))), size
+
+    def block_files(self):
+        return ((prefix, file_path, size) for _, prefix, file_path, size in self.user_blocks())
+
+    def usage(self):
+        """Return {user id: summed size of their blocks}."""
+        usage = {}
+        for user, _, _, size in self.user_blocks():
+            usage[user['id']] = usage.get(user['id'], 0) + size
+        return usage
+
+    def drops(self):
+        """Yield (user, drop id) of all users, drop_messages and identities use the same ones."""
+        rng = self.rng('drop-ids')
+        for user in self.users():
+            yield user, base64.urlsafe_b64encode(rng.getrandbits(256).to_bytes(32, 'little')).decode().rstrip('=')
+
+    def drop_messages(self):
+        rng = self.rng('drops')
+        n = 0
+        for user, drop_id in self.drops():
+            for _ in range(self.messages):
+                size = rng.randrange(64, 2048)
+                yield self.message_ids()[n], drop_id, rng.getrandbits(size * 8).to_bytes(size, 'little'), \
+                    self.timestamp(rng)
+                n += 1
+
+    def identities(self):
+        rng = self.rng('identities')
+        for user, drop_id in self.drops():
+            public_key = '%064x' % rng.getrandbits(256)
+            yield user, public_key, self.drop_url.rstrip('/') + '/' + drop_id
+
+
+# Tables filled per database: (table, columns, key column, ids(dataset), cleanup SQL, rows(dataset))
+# The key column holds the seeded ids (ids(dataset), a range from SEED_ID_BASE on), the cleanup SQL deletes the rows
+# (and their children) with keys from %(start)s to %(stop)s (exclusive) of the previously seeded dataset.
+# The layouts mirror the applications' models; children come after their parents.
+TABLES = {
+    'qabel-accounting': [
+        ('auth_user',
+         ('id', 'password', 'is_superuser', 'username', 'first_name', 'last_name', 'email', 'is_staff',
+          'is_active', 'date_joined'),
+         'id', Dataset.user_ids,
+         "DELETE FROM auth_user WHERE id >= %(start)s AND id < %(stop)s AND username LIKE 'seed-%%'",
+         lambda dataset: ((user['id'], user['password'], False, user['username'], '', '', user['email'], False,
+                           True, user['joined']) for user in dataset.users())),
+        ('authtoken_token',
+         ('key', 'created', 'user_id'),
+         'user_id', Dataset.user_ids,
+         'DELETE FROM authtoken_token WHERE user_id >= %(start)s AND user_id < %(stop)s',
+         lambda dataset: ((user['token'], user['joined'], user['id']) for user in dataset.users())),
+        ('qabel_provider_profile',
+         ('id', 'user_id', 'quota'),
+         'id', Dataset.user_ids,
+         'DELETE FROM qabel_provider_profile WHERE id >= %(start)s AND id < %(stop)s',
+         lambda dataset: ((user['id'], user['id'], user['quota']) for user in dataset.users())),
+    ],
+    'qabel-block': [
+        ('prefixes',
+         ('name', 'user_id'),
+         'user_id', Dataset.user_ids,
+         'DELETE FROM files WHERE prefix IN '
+         '(SELECT name FROM prefixes WHERE user_id >= %(start)s AND user_id < %(stop)s);'
+         'DELETE FROM prefixes WHERE user_id >= %(start)s AND user_id < %(stop)s',
+         lambda dataset: ((prefix, user['id']) for user, prefix in dataset.prefixes())),
+        ('files',
+         ('prefix', 'file_path', 'size'),
+         None, None, None,
+         lambda dataset: dataset.block_files()),
+    ],
+    'qabel-drop': [
+        ('drop_service_drop',
+         ('id', 'drop_id', 'message', 'created_at'),
+         'id', Dataset.message_ids,
+         'DELETE FROM drop_service_drop WHERE id >= %(start)s AND id < %(stop)s',
+         lambda dataset: dataset.drop_messages()),
+    ],
+    'qabel-index': [
+        ('index_service_identity',
+         ('id', 'alias', 'public_key', 'drop_url'),
+         'id', Dataset.user_ids,
+         'DELETE FROM index_service_entry WHERE identity_id >= %(start)s AND identity_id < %(stop)s;'
+         "DELETE FROM index_service_identity WHERE id >= %(start)s AND id < %(stop)s AND alias LIKE 'seed-%%'",
+         lambda dataset: ((user['id'], user['username'], public_key, drop_url)
+                          for user, public_key, drop_url in dataset.identities())),
+        ('index_service_entry',
+         ('id', 'identity_id', 'field', 'value'),
+         'id', Dataset.user_ids, None,
+         lambda dataset: ((user['id'], user['id'], 'email', user['email']) for user, *_ in dataset.identities())),
+    ],
+}
+
+
+def check_columns(cursor, name):
+    """Check the TABLES of database *name* against its schema, return list of error messages."""
+    cursor.execute('SELECT table_name, column_name, is_nullable, column_default FROM information_schema.columns '
+                   'WHERE table_schema = current_schema() AND table_name IN %s',
+                   (tuple(table for table, *_ in TABLES[name]),))
+    schema = {}
+    for table, column, nullable, default in cursor.fetchall():
+        schema.setdefault(table, {})[column] = nullable == 'YES' or default is not None
+    errors = []
+    for table, columns, *_ in TABLES[name]:
+        if table not in schema:
+            errors.append('table {} missing'.format(table))
+            continue
+        for column in columns:
+            if column not in schema[table]:
+                errors.append('column {}.{} missing'.format(table, column))
+        for column, optional in sorted(schema[table].items()):
+            if not optional and column not in columns:
+                errors.append('column {}.{} is NOT NULL without default, but not seeded'.format(table, column))
+    return errors
+
+
+def check_ids(cursor, table, key, ids):
+    """Check that no row of *table* uses one of the *ids* (in column *key*) and that its sequence is below them."""
+    cursor.execute('SELECT {key} FROM {table} WHERE {key} >= %(start)s AND {key} < %(stop)s LIMIT 1'.format(
+        table=table, key=key), {'start': ids.start, 'stop': ids.stop})
+    used = cursor.fetchone()
+    if used:
+        raise SeedError('{}.{} {} is in the range reserved for seeded rows, but was not seeded'.format(
+            table, key, used[0]))
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', (table, key))
+    sequence, = cursor.fetchone()
+    if sequence:
+        cursor.execute('SELECT last_value FROM {}'.format(sequence))
+        last_value, = cursor.fetchone()
+        if last_value >= ids.start:
+            raise SeedError('sequence {} ({}) has reached the range reserved for seeded rows ({})'.format(
+                sequence, last_value, ids.start))
+
+
+def check_usage(cursor, dataset):
+    """Check that the seeded block sizes add up to the expected usage of each user."""
+    users = dataset.user_ids()
+    cursor.execute('SELECT prefixes.user_id, sum(files.size) FROM files JOIN prefixes ON files.prefix = prefixes.name '
+                   'WHERE prefixes.user_id >= %(start)s AND prefixes.user_id < %(stop)s GROUP BY prefixes.user_id',
+                   {'start': users.start, 'stop': users.stop})
+    usage = {user_id: int(size) for user_id, size in cursor.fetchall()}
+    expected = dataset.usage()
+    for user_id in sorted(set(usage) | set(expected)):
+        if usage.get(user_id, 0) != expected.get(user_id, 0):
+            raise SeedError('usage of user {} is {} bytes, expected {}'.format(
+                user_id, usage.get(user_id, 0), expected.get(user_id, 0)))
+
+
+# Checks of the seeded rows per database: check(cursor, dataset) raises SeedError
+CHECKS = {
+    'qabel-block': check_usage,
+}
+
+
+def seeded_dataset(cursor):
+    """Return the dataset last seeded into the database of *cursor* (None if there is none)."""
+    cursor.execute('CREATE TABLE IF NOT EXISTS seed_marker '
+                   '(scale integer, seed bigint, blocks integer, messages integer)')
+    cursor.execute('SELECT scale, seed, blocks, messages FROM seed_marker')
+    row = cursor.fetchone()
+    return Dataset(*row) if row else None
+
+
+def mark_seeded(cursor, dataset):
+    cursor.execute('DELETE FROM seed_marker')
+    cursor.execute('INSERT INTO seed_marker (scale, seed, blocks, messages) VALUES (%s, %s, %s, %s)',
+                   (dataset.scale, dataset.seed, dataset.blocks, dataset.messages))
+
+
+def copy_value(value):
+    """Format *value* for COPY's text format."""
+    if value is None:
+        return r'\N'
+    if isinstance(value, bytes):
+        return r'\\x' + value.hex()
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cursor, table, columns, rows):
+    """COPY *rows* into *table* in batches and return the number of rows."""
+    statement = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns))
+    count = 0
+    buffer = io.StringIO()
+    for count, row in enumerate(rows, 1):
+        buffer.write('\t'.join(map(copy_value, row)) + '\n')
+        if not count % COPY_BATCH:
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cursor.copy_expert(statement, buffer)
+    return count
+
+
+def seed_database(name, dataset):
+    """Replace the seeded rows of database *name* with *dataset*. Return {table: number of rows}."""
+    counts = {}
+    connection = psycopg2.connect(host='/tmp', port=PGSQL_SUFFIX, dbname=name, user=name)
+    try:
+        with connection, connection.cursor() as cursor:
+            errors = check_columns(cursor, name)
+            if errors:
+                raise SeedError('\n'.join(errors))
+            previous = seeded_dataset(cursor)
+            for table, columns, key, ids, cleanup, rows in TABLES[name]:
+                if cleanup and previous:
+                    seeded = ids(previous)
+                    cursor.execute(cleanup, {'start': seeded.start, 'stop': seeded.stop})
+                if key:
+                    check_ids(cursor, table, key, ids(dataset))
+                counts[table] = copy_rows(cursor, table, columns, rows(dataset))
+            if name in CHECKS:
+                CHECKS[name](cursor, dataset)
+            mark_seeded(cursor, dataset)
+    finally:
+        connection.close()
+    return counts
+
+
+def seed_all(scale, seed, blocks, messages, drop_url):
+    """Seed all databases in parallel, print the number of rows per table. Identities use drops at *drop_url*."""
+    dataset = Dataset(scale, seed, blocks, messages, drop_url)
+    with concurrent.futures.ProcessPoolExecutor(len(TABLES)) as executor:
+        futures = {executor.submit(seed_database, name, dataset): name for name in TABLES}
+        failed = False
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                counts = future.result()
+            except SeedError as error:
+                cprint('{}: seeding failed'.format(name), 'red', attrs=['bold'])
+                print(error)
+                failed = True
+                continue
+            except psycopg2.Error as error:
+                cprint('{}: seeding failed (run "inv deploy" first?)'.format(name), 'red', attrs=['bold'])
+                print(error)
+                failed = True
+                continue
+            for table, count in counts.items():
+                print('{}: {} rows in {}'.format(name, count, table))
+    return not failed
@@ -1,6 +1,6 @@
 
 """
-Tasks for managing ad-hoc PostgreSQL and Redis instances for testing purposes.
+Tasks for managing ad-hoc PostgreSQL, Redis and S3 (stand-in) instances for testing purposes.
 """
 
 import os
@@ -8,9 +8,11 @@ import shutil
 import signal
 import sys
 import time
+import xml.etree.ElementTree as ET
 from pathlib import Path
 from shutil import which
 
+import requests
 from termcolor import cprint
 
 from invoke import Collection, Failure, task, run
@@ -45,6 +47,17 @@ else:
 
 REDIS_PORT = 27902
 
+S3_PORT = 27903
+S3_URL = 'http://localhost:{}/'.format(S3_PORT)
+
+# Credentials are not checked by the S3 stand-in, but clients insist on having some.
+S3_ENV = {
+    'AWS_ACCESS_KEY_ID': 'qabel',
+    'AWS_SECRET_ACCESS_KEY': 'qabel',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ENDPOINT_URL': S3_URL,
+}
+
 
 def kill_pidfile(path, signo=signal.SIGTERM, unlink=True):
     try:
@@ -155,6 +168,40 @@ def start_redis(ctx):
     print('redis started')
 
 
+@task(name='s3')
+def start_s3(ctx):
+    app_data = Path(ctx.qabel.testing.app_data)
+    s3_path = app_data / 's3'
+    s3_pidfile = app_data / 's3.pid'
+    if pidfile_alive(s3_pidfile):
+        print('s3 is running')
+        return
+    command_line = [
+        ctx.qabel.testing.s3,
+        '-H', 'localhost',
+        '-p', S3_PORT,
+        '>', s3_path.with_suffix('.log'), '2>&1',
+        '&', 'echo', '$!', '>', s3_pidfile,
+    ]
+    app_data.mkdir(exist_ok=True, parents=True)
+    run(' '.join(map(str, command_line)))
+
+    # Wait for the S3 server to start up and create the bucket (it does not persist anything)
+    for i in range(10):
+        try:
+            time.sleep(1)
+            requests.put(S3_URL + ctx.qabel.testing.s3_bucket).raise_for_status()
+        except requests.RequestException:
+            pass
+        else:
+            break
+    else:
+        cprint('Could not start S3 server.', 'red', attrs=['bold'])
+        cprint('Check {log} for errors'.format(log=s3_path.with_suffix('.log')), attrs=['bold'])
+        sys.exit(1)
+    print('s3 started')
+
+
 @task(pre=[start_postgres, start_redis])
 def start_all(ctx):
     """
@@ -168,6 +215,7 @@ start_servers = Collection('start')
 start_servers.add_task(start_all, default=True)
 start_servers.add_task(start_postgres)
 start_servers.add_task(start_redis)
+start_servers.add_task(start_s3)
 
 
 @task(name='postgres')
@@ -185,10 +233,37 @@ def stop_redis(ctx):
     kill_pidfile(redis_pidfile, unlink=False)
 
 
-@task(pre=[stop_postgres, stop_redis])
+def s3_keys(ctx):
+    """Return the keys of all objects in the bucket of the S3 stand-in."""
+    keys = []
+    params = {'list-type': 2}
+    while True:
+        response = requests.get(S3_URL + ctx.qabel.testing.s3_bucket, params=params)
+        response.raise_for_status()
+        listing = {}
+        for element in ET.fromstring(response.content).iter():
+            tag = element.tag.rpartition('}')[2]
+            if tag == 'Key':
+                keys.append(element.text)
+            else:
+                listing[tag] = element.text
+        if listing.get('IsTruncated') != 'true':
+            return keys
+        params['continuation-token'] = listing['NextContinuationToken']
+
+
+@task(name='s3')
+def stop_s3(ctx):
+    app_data = Path(ctx.qabel.testing.app_data)
+    s3_pidfile = app_data / 's3.pid'
+    if pidfile_alive(s3_pidfile):
+        kill_pidfile(s3_pidfile)
+
+
+@task(pre=[stop_postgres, stop_redis, stop_s3])
 def stop_all(ctx):
     """
-    Stop PostgreSQL and Redis servers.
+    Stop PostgreSQL, Redis and S3 servers.
     """
 
 
@@ -215,6 +290,12 @@ def status(ctx):
     else:
         print('redis is stopped')
 
+    s3_pidfile = app_data / 's3.pid'
+    if pidfile_alive(s3_pidfile):
+        print('s3 is started, PID', s3_pidfile.read_text().strip())
+    else:
+        print('s3 is stopped')
+
     pgsql_path = app_data / 'postgres'
     pg_ctl = ctx.qabel.testing.pgctl
     if not pgsql_path.exists():
@@ -227,6 +308,7 @@ stop_servers = Collection('stop')
 stop_servers.add_task(stop_all, default=True)
 stop_servers.add_task(stop_postgres)
 stop_servers.add_task(stop_redis)
+stop_servers.add_task(stop_s3)
 
 servers = Collection('servers')
 servers.add_collection(start_servers)
@@ -0,0 +1,82 @@
+
+import json
+from pathlib import Path
+
+import pytest
+
+# A local HTTP server for the tests run by pytester: /slow takes 200 ms, every response reports server timings.
+SERVER = '''
+import http.server
+import threading
+import time
+
+import pytest
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(0.2)
+        self.send_response(200)
+        self.send_header('Server-Timing', 'db;dur=53, app;dur="47.2", cache;desc="hit", broken;dur=soon')
+        self.send_header('X-Runtime', '0.012')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    httpd.shutdown()
+'''
+
+TESTS = '''
+import requests
+
+
+def test_fast(server):
+    requests.get(server + '/fast')
+
+
+def test_slow(server):
+    requests.get(server + '/slow')
+'''
+
+
+@pytest.fixture
+def run_latency(pytester, monkeypatch):
+    """Run TESTS with the latency plugin and the given command line arguments."""
+    monkeypatch.setenv('PYTHONPATH', str(Path(__file__).parent.parent))
+    pytester.makeconftest(SERVER)
+    pytester.makepyfile(test_requests=TESTS)
+
+    def run(*args):
+        return pytester.runpytest_subprocess('-p', 'pytest_latency', *args)
+    return run
+
+
+def test_over_budget_fails(run_latency):
+    result = run_latency('--latency-budget', 'GET /slow 0.1', '--latency-budget', '* * 1')
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines(['*Latency budget exceeded*', '*GET http://127.0.0.1:*/slow*[budget: 100.0 ms]*'])
+
+
+def test_ignore_latency_budgets(run_latency):
+    result = run_latency('--latency-budget', 'GET /slow 0.1', '--ignore-latency-budgets')
+    result.assert_outcomes(passed=2)
+
+
+def test_server_timings(run_latency, pytester):
+    report = pytester.path / 'latency.json'
+    run_latency('--latency-report', str(report)).assert_outcomes(passed=2)
+    calls = json.loads(report.read_text())
+    assert [call['endpoint'] for call in calls] == ['GET /fast', 'GET /slow']
+    for call in calls:
+        assert call['server'] == {'db': 53.0, 'app': 47.2, 'runtime': 12.0}
+        assert call['budget'] is None
+    assert calls[1]['total'] >= 0.2